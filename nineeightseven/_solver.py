@@ -0,0 +1,257 @@
+"""Search for the best move on a bitboard.
+
+The values of a board are packed into a single int, four bits per cell, with
+cell (i, j) stored at bits 16 * i + 4 * j. Values beyond 15 saturate at 15.
+Everything here works on plain ints, directions are indexed in the order up,
+down, left, right.
+"""
+
+from __future__ import annotations
+
+import functools
+from collections.abc import Iterable, Sequence
+
+BOARD_SIZE = 4
+
+CELL_BITS = 4
+CELL_MASK = (1 << CELL_BITS) - 1
+ROW_BITS = CELL_BITS * BOARD_SIZE
+ROW_MASK = (1 << ROW_BITS) - 1
+# The lowest bit of every cell of a bitboard.
+CELL_LOW_BITS = int("1" * BOARD_SIZE**2, 16)
+
+GAME_OVER_SCORE = -123456789
+
+
+def merge_pair(first: int, second: int) -> int:
+    """Get the value two neighbouring values merge into, or 0 if they don't."""
+    if first == second == 1 or abs(first - second) == 1:
+        return max(first, second) + 1
+    return 0
+
+
+# MERGE_PAIR_TABLE[a][b] is merge_pair(a, b) for all values below
+# MERGE_PAIR_SIZE, larger values fall back to calling merge_pair.
+MERGE_PAIR_SIZE = 32
+MERGE_PAIR_TABLE = [
+    [merge_pair(first, second) for second in range(MERGE_PAIR_SIZE)]
+    for first in range(MERGE_PAIR_SIZE)
+]
+
+
+def merge_values(group: Sequence[int]) -> tuple[tuple[int, ...], int]:
+    """Merge the values of a group towards its start."""
+    values = [value for value in group if value]
+
+    new_values: list[int] = []
+    score = 0
+    i = 0
+    while i + 1 < len(values):
+        first, second = values[i], values[i + 1]
+        if first < MERGE_PAIR_SIZE and second < MERGE_PAIR_SIZE:
+            merged = MERGE_PAIR_TABLE[first][second]
+        else:
+            merged = merge_pair(first, second)
+        if merged:
+            new_values.append(merged)
+            score += first + second
+            i += 2
+        else:
+            new_values.append(first)
+            i += 1
+    new_values.extend(values[i:])
+
+    return tuple(new_values), score
+
+
+def row_cells(row: int) -> tuple[int, ...]:
+    """Unpack a row of the bitboard into its values."""
+    return tuple((row >> (CELL_BITS * j)) & CELL_MASK for j in range(BOARD_SIZE))
+
+
+def pack_row(values: Iterable[int]) -> int:
+    """Pack a row of values into the bitboard format."""
+    row = 0
+    for j, value in enumerate(values):
+        row |= min(value, CELL_MASK) << (CELL_BITS * j)
+    return row
+
+
+def reverse_row(row: int) -> int:
+    """Reverse the cells of a row of the bitboard."""
+    return pack_row(reversed(row_cells(row)))
+
+
+def _build_row_tables() -> tuple[
+    list[tuple[int, ...]], list[int], list[int], list[int], list[int]
+]:
+    """Precompute the result of moving every possible row left and right."""
+    merge_table: list[tuple[int, ...]] = [()] * (1 << ROW_BITS)
+    merged_values: dict[tuple[int, ...], tuple[int, ...]] = {}
+    left_table = [0] * (1 << ROW_BITS)
+    left_score_table = [0] * (1 << ROW_BITS)
+    for row in range(1 << ROW_BITS):
+        new_values, score = merge_values(row_cells(row))
+        merge_table[row] = merged_values.setdefault(new_values, new_values)
+        left_table[row] = pack_row(new_values)
+        left_score_table[row] = score
+
+    right_table = [0] * (1 << ROW_BITS)
+    right_score_table = [0] * (1 << ROW_BITS)
+    for row in range(1 << ROW_BITS):
+        reversed_row = reverse_row(row)
+        right_table[row] = reverse_row(left_table[reversed_row])
+        right_score_table[row] = left_score_table[reversed_row]
+
+    return merge_table, left_table, left_score_table, right_table, right_score_table
+
+
+# MERGE_TABLE holds the exact merged values of each row, without saturation.
+(
+    MERGE_TABLE,
+    ROW_LEFT_TABLE,
+    ROW_LEFT_SCORE_TABLE,
+    ROW_RIGHT_TABLE,
+    ROW_RIGHT_SCORE_TABLE,
+) = _build_row_tables()
+
+
+def transpose_bits(values: int) -> int:
+    """Transpose a bitboard."""
+    a1 = values & 0xF0F00F0FF0F00F0F
+    a2 = values & 0x0000F0F00000F0F0
+    a3 = values & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def all_moves_bits(values: int) -> tuple[tuple[int, int], ...]:
+    """Move a bitboard in every direction at once.
+
+    Rows and columns are moved in the same pass, so up and down share a single
+    transpose of the board.
+    """
+    transposed = transpose_bits(values)
+    up = down = left = right = 0
+    up_score = down_score = left_score = right_score = 0
+    for shift in range(0, ROW_BITS * BOARD_SIZE, ROW_BITS):
+        column = (transposed >> shift) & ROW_MASK
+        up |= ROW_LEFT_TABLE[column] << shift
+        up_score += ROW_LEFT_SCORE_TABLE[column]
+        down |= ROW_RIGHT_TABLE[column] << shift
+        down_score += ROW_RIGHT_SCORE_TABLE[column]
+
+        row = (values >> shift) & ROW_MASK
+        left |= ROW_LEFT_TABLE[row] << shift
+        left_score += ROW_LEFT_SCORE_TABLE[row]
+        right |= ROW_RIGHT_TABLE[row] << shift
+        right_score += ROW_RIGHT_SCORE_TABLE[row]
+    return (
+        (transpose_bits(up), up_score),
+        (transpose_bits(down), down_score),
+        (left, left_score),
+        (right, right_score),
+    )
+
+
+def empty_mask_bits(values: int) -> int:
+    """Get a mask with the lowest bit of every empty cell of a bitboard set."""
+    occupied = values | (values >> 1) | (values >> 2) | (values >> 3)
+    return ~occupied & CELL_LOW_BITS
+
+
+def is_game_over_bits(values: int) -> bool:
+    """Check if no move changes a bitboard.
+
+    That is the case when no cell is empty and moving any full row or column
+    left leaves it unchanged.
+    """
+    if empty_mask_bits(values):
+        return False
+    transposed = transpose_bits(values)
+    for shift in range(0, ROW_BITS * BOARD_SIZE, ROW_BITS):
+        row = (values >> shift) & ROW_MASK
+        column = (transposed >> shift) & ROW_MASK
+        if ROW_LEFT_TABLE[row] != row or ROW_LEFT_TABLE[column] != column:
+            return False
+    return True
+
+
+# Bit offsets of all cells, stepping BOARD_SIZE + 1 cells at a time so that
+# consecutive cells fall in different rows and columns.
+SPREAD_SHIFTS = tuple(
+    (k * (BOARD_SIZE + 1) % BOARD_SIZE**2) * CELL_BITS for k in range(BOARD_SIZE**2)
+)
+
+
+def empty_shifts_bits(values: int) -> list[int]:
+    """Get the bit offsets of the empty cells of a bitboard.
+
+    The cells are listed in SPREAD_SHIFTS order.
+    """
+    return [shift for shift in SPREAD_SHIFTS if not (values >> shift) & CELL_MASK]
+
+
+def expected_score_bits(
+    values: int,
+    depth: int,
+    max_empty: int,
+    cache: dict[tuple[int, int], float] | None = None,
+) -> float:
+    """Get the expected score of a bitboard before a random tile is added.
+
+    Only the first `max_empty` empty cells in SPREAD_SHIFTS order are expanded,
+    so with more empty cells than that the result is an estimate over a
+    subsample spread across rows and columns. Results are memoized in `cache`,
+    which can be shared between calls of the same search and is dropped
+    afterwards.
+    """
+    if cache is None:
+        cache = {}
+    key = (values, depth)
+    if key in cache:
+        return cache[key]
+    empty_shifts = empty_shifts_bits(values)
+    if not empty_shifts:
+        cache[key] = best_move_bits(values, depth, max_empty, cache)[1]
+        return cache[key]
+    empty_shifts = empty_shifts[:max_empty]
+    cache[key] = sum(
+        0.9 * best_move_bits(values | (1 << shift), depth, max_empty, cache)[1]
+        + 0.1 * best_move_bits(values | (2 << shift), depth, max_empty, cache)[1]
+        for shift in empty_shifts
+    ) / len(empty_shifts)
+    return cache[key]
+
+
+def best_move_bits(
+    values: int,
+    depth: int,
+    max_empty: int,
+    cache: dict[tuple[int, int], float] | None = None,
+) -> tuple[int, float]:
+    """Find the index of the best direction for a bitboard and its score.
+
+    Random tiles are evaluated as an expectation over at most `max_empty`
+    empty cells. Expected scores are memoized in `cache` for the length of the
+    search. A board that no direction moves scores GAME_OVER_SCORE.
+    """
+    if cache is None:
+        cache = {}
+    best_score = float("-inf")
+    best_direction = 0
+    for index, (new_values, score) in enumerate(all_moves_bits(values)):
+        if new_values == values:
+            continue
+        if depth > 0:
+            score += expected_score_bits(new_values, depth - 1, max_empty, cache)
+        if score > best_score:
+            best_score = score
+            best_direction = index
+    if best_score == float("-inf"):
+        return 0, GAME_OVER_SCORE
+    return best_direction, best_score
@@ -2,9 +2,12 @@
 
 from __future__ import annotations
 
+import asyncio
 import dataclasses
 import enum
+import functools
 import random
+from collections.abc import Iterable
 from typing import Union
 
 from reflex_global_hotkey import global_hotkey_watcher
@@ -14,6 +17,21 @@ from reflex_swipe import swipeable
 import reflex as rx
 from reflex.vars.sequence import LiteralArrayVar
 
+from ._solver import (
+    BOARD_SIZE,
+    CELL_BITS,
+    CELL_MASK,
+    GAME_OVER_SCORE,
+    MERGE_TABLE,
+    ROW_LEFT_SCORE_TABLE,
+    all_moves_bits,
+    best_move_bits,
+    empty_mask_bits,
+    expected_score_bits,
+    is_game_over_bits,
+    merge_values,
+)
+
 CELL = tuple[int, int]
 
 GROUP = tuple[CELL, ...]
@@ -29,84 +47,110 @@ class Direction(enum.Enum):
     RIGHT = "ArrowRight"
 
 
-def pad_values(v: list[CELL]) -> GROUP:
-    """Pad values with zeros."""
-    if len(v) > BOARD_SIZE:
-        raise ValueError(f"Values cannot have more than {BOARD_SIZE} elements.")
-    return tuple(v + [(0, get_random_key()) for _ in range(BOARD_SIZE - len(v))])
+_ALL_DIRECTIONS = tuple(Direction)
+_DIRECTION_INDICES = {direction: i for i, direction in enumerate(_ALL_DIRECTIONS)}
+_KEY_TO_DIRECTION = {direction.value: direction for direction in _ALL_DIRECTIONS}
 
 
-def combine_values(group: GROUP) -> tuple[list[CELL], int]:
-    """Combine values in a list."""
-    values = list(filter(lambda cell: cell[0], group))
+def attach_keys(group: GROUP, values: Iterable[int]) -> list[CELL]:
+    """Attach the keys of a group to its merged values.
 
+    Each resulting cell keeps the key of the cell it came from, or of the
+    second cell for a merge.
+    """
+    cells = iter([cell for cell in group if cell[0]])
     new_values: list[CELL] = []
-    values_counter = 0
-    score = 0
-    for i in range(len(values)):
-        if values_counter == i + 1:
-            continue
-        values_counter = values_counter + 1
-        if i + 1 < len(values):
-            if values[i][0] == values[i + 1][0] == 1:
-                new_values.append((2, values[i + 1][1]))
-                values_counter = values_counter + 1
-                score += 2
-            elif abs(values[i][0] - values[i + 1][0]) == 1:
-                new_values.append(
-                    (max(values[i][0], values[i + 1][0]) + 1, values[i + 1][1])
-                )
-                score += values[i][0] + values[i + 1][0]
-                values_counter = values_counter + 1
-            else:
-                new_values.append(values[i])
-        else:
-            new_values.append(values[i])
-
-    return new_values, score
+    for value in values:
+        source_value, key = next(cells)
+        if value != source_value:
+            _, key = next(cells)
+        new_values.append((value, key))
+    return new_values
 
 
-def reverse(group: GROUP) -> GROUP:
-    """Reverse a group."""
-    return group[::-1]
-
-
-def ith_column(board: BOARD, i: int) -> GROUP:
-    """Get the ith column of a board."""
-    return tuple(board[j][i] for j in range(BOARD_SIZE))
-
-
-def ith_row(board: BOARD, i: int) -> GROUP:
-    """Get the ith row of a board."""
-    return board[i]
-
-
-def transpose(board: BOARD) -> BOARD:
-    """Transpose a board."""
-    return tuple(ith_column(board, i) for i in range(BOARD_SIZE))
+def combine_values(group: GROUP) -> tuple[list[CELL], int]:
+    """Combine values in a list."""
+    values, score = merge_values([cell[0] for cell in group])
+    return attach_keys(group, values), score
 
 
 def get_random_key() -> int:
     """Get a random key."""
-    return random.randint(0, 1000000)
+    return random.getrandbits(20)
 
 
 def insert_value_row(row: GROUP, i: int, value: int) -> GROUP:
     """Insert a value into a row."""
-    random_value = get_random_key()
-
-    return tuple((value, random_value) if i == j else row[j] for j in range(BOARD_SIZE))
+    return row[:i] + ((value, get_random_key()),) + row[i + 1 :]
 
 
 def insert_value(board: BOARD, i: int, j: int, value: int) -> BOARD:
     """Insert a value into a board."""
-    return tuple(
-        insert_value_row(board[k], j, value) if i == k else board[k]
-        for k in range(BOARD_SIZE)
+    return board[:i] + (insert_value_row(board[i], j, value),) + board[i + 1 :]
+
+
+def pack_board(board: BOARD) -> int:
+    """Pack the values of a board into a bitboard."""
+    values = 0
+    shift = 0
+    for row in board:
+        for value, _ in row:
+            values |= min(value, CELL_MASK) << shift
+            shift += CELL_BITS
+    return values
+
+
+def merge_group(group: GROUP) -> tuple[list[CELL], int]:
+    """Combine values in a group using the precomputed merge table."""
+    values = [cell[0] for cell in group]
+    if max(values) > CELL_MASK:
+        return combine_values(group)
+    row = (
+        values[0]
+        | values[1] << CELL_BITS
+        | values[2] << 2 * CELL_BITS
+        | values[3] << 3 * CELL_BITS
+    )
+    return attach_keys(group, MERGE_TABLE[row]), ROW_LEFT_SCORE_TABLE[row]
+
+
+# Flat cell indices of every line of the board, in the order its cells move.
+UP_LINES = tuple(tuple(range(j, BOARD_SIZE**2, BOARD_SIZE)) for j in range(BOARD_SIZE))
+DOWN_LINES = tuple(line[::-1] for line in UP_LINES)
+LEFT_LINES = tuple(
+    tuple(range(i * BOARD_SIZE, (i + 1) * BOARD_SIZE)) for i in range(BOARD_SIZE)
+)
+RIGHT_LINES = tuple(line[::-1] for line in LEFT_LINES)
+
+
+def move_lines(board: BOARD, lines: tuple[tuple[int, ...], ...]) -> tuple[BOARD, int]:
+    """Move a board along its lines.
+
+    The cells are moved within a single flat working list, which is only
+    split back into rows at the end.
+    """
+    cells = [cell for row in board for cell in row]
+    new_cells = cells[:]
+    total_score = 0
+    for line in lines:
+        values, score = merge_group(tuple(cells[k] for k in line))
+        total_score += score
+        for k, cell in zip(line, values):
+            new_cells[k] = cell
+        for k in line[len(values) :]:
+            new_cells[k] = (0, get_random_key())
+    return (
+        tuple(
+            tuple(new_cells[i : i + BOARD_SIZE])
+            for i in range(0, BOARD_SIZE**2, BOARD_SIZE)
+        ),
+        total_score,
     )
 
 
-BOARD_SIZE = 4
+def move_bits(values: int, direction: Direction) -> tuple[int, int]:
+    """Move a bitboard in a direction."""
+    return all_moves_bits(values)[_DIRECTION_INDICES[direction]]
 
 
 @dataclasses.dataclass(
@@ -119,110 +163,118 @@ class TwentyFourtyEightBoard:
         tuple((0, get_random_key()) for _ in range(BOARD_SIZE))
         for _ in range(BOARD_SIZE)
     )
+    values: int = dataclasses.field(init=False, repr=False, compare=False)
+    _moves: dict[Direction, tuple[TwentyFourtyEightBoard | None, int]] = (
+        dataclasses.field(default_factory=dict, init=False, repr=False, compare=False)
+    )
+
+    def __post_init__(self):
+        """Pack the values of the board."""
+        object.__setattr__(self, "values", pack_board(self.board))
 
     def is_game_over(self) -> bool:
         """Check if the game is over."""
-        return all(self.move(direction) is None for direction in Direction)
+        return self._is_game_over
+
+    @functools.cached_property
+    def _is_game_over(self) -> bool:
+        if self._is_saturated:
+            return all(self.move(direction)[0] is None for direction in _ALL_DIRECTIONS)
+        return is_game_over_bits(self.values)
 
     def move(self, direction: Direction) -> tuple[TwentyFourtyEightBoard | None, int]:
         """Move the board in a direction."""
-        match direction:
-            case Direction.UP:
-                board, score = self._move_up()
-            case Direction.DOWN:
-                board, score = self._move_down()
-            case Direction.LEFT:
-                board, score = self._move_left()
-            case Direction.RIGHT:
-                board, score = self._move_right()
+        if direction in self._moves:
+            return self._moves[direction]
+
+        if not self._is_saturated:
+            new_values, _ = move_bits(self.values, direction)
+            if new_values == self.values:
+                self._moves[direction] = None, 0
+                return self._moves[direction]
+
+        board, score = self._MOVE_FNS[_DIRECTION_INDICES[direction]](self)
 
         assert board is not None
 
-        if self._just_values() == board._just_values():
-            return None, 0
-        return board, score
+        if self._just_values == board._just_values:
+            self._moves[direction] = None, 0
+        else:
+            self._moves[direction] = board, score
+        return self._moves[direction]
 
-    def best_move(self, depth: int, breadth: int) -> tuple[Direction, int]:
+    def best_move(self, depth: int, max_empty: int) -> tuple[Direction, float]:
         """Find the best move."""
-        if self.is_game_over():
-            return Direction.UP, -123456789
-        best_score = -1
+        if max_empty < 1:
+            raise ValueError(f"max_empty must be at least 1, got {max_empty}.")
+        if self._is_saturated:
+            direction, score = self._best_legal_move(depth, max_empty)
+        else:
+            index, score = best_move_bits(self.values, depth, max_empty)
+            direction = _ALL_DIRECTIONS[index]
+        return direction, score
+
+    def _best_legal_move(self, depth: int, max_empty: int) -> tuple[Direction, float]:
+        # The bitboard cannot tell which moves are legal once values saturate,
+        # so the first move is made on the keyed board and only the rest of
+        # the search runs on the bitboard.
+        cache: dict[tuple[int, int], float] = {}
+        best_score = float("-inf")
         best_direction = Direction.UP
-        for direction in Direction:
-            new_board, score = self.move(direction)
-            if new_board is not None:
-                if depth > 0:
-                    average_additional_score = (
-                        sum(
-                            new_board.with_random_tile().best_move(depth - 1, breadth)[
-                                1
-                            ]
-                            for _ in range(breadth)
-                        )
-                        // breadth
-                    )
-                    score += average_additional_score
-                if score > best_score:
-                    best_score = score
-                    best_direction = direction
+        for direction in _ALL_DIRECTIONS:
+            board, score = self.move(direction)
+            if board is None:
+                continue
+            if depth > 0:
+                score += expected_score_bits(board.values, depth - 1, max_empty, cache)
+            if score > best_score:
+                best_score = score
+                best_direction = direction
+        if best_score == float("-inf"):
+            return Direction.UP, GAME_OVER_SCORE
         return best_direction, best_score
 
     def _move_up(self) -> tuple[TwentyFourtyEightBoard, int]:
-        new_board = []
-        total_score = 0
-        for i in range(BOARD_SIZE):
-            values, score = combine_values(ith_column(self.board, i))
-            total_score += score
-            new_board.append(pad_values(values))
-
-        return TwentyFourtyEightBoard(transpose(tuple(new_board))), total_score
+        board, score = move_lines(self.board, UP_LINES)
+        return TwentyFourtyEightBoard(board), score
 
     def _move_down(self) -> tuple[TwentyFourtyEightBoard, int]:
-        new_board = []
-        total_score = 0
-        for i in range(BOARD_SIZE):
-            values, score = combine_values(reverse(ith_column(self.board, i)))
-            total_score += score
-            new_board.append(reverse(pad_values(values)))
-
-        return TwentyFourtyEightBoard(transpose(tuple(new_board))), total_score
-
-    def _move_left(self) -> tuple[TwentyFourtyEightBoard | None, int]:
-        new_board = []
-        total_score = 0
-        for i in range(BOARD_SIZE):
-            values, score = combine_values(ith_row(self.board, i))
-            total_score += score
-            new_board.append(pad_values(values))
-
-        return TwentyFourtyEightBoard(tuple(new_board)), total_score
-
-    def _move_right(self) -> tuple[TwentyFourtyEightBoard | None, int]:
-        new_board = []
-        total_score = 0
-        for i in range(BOARD_SIZE):
-            values, score = combine_values(reverse(ith_row(self.board, i)))
-            total_score += score
-            new_board.append(reverse(pad_values(values)))
-
-        return TwentyFourtyEightBoard(tuple(new_board)), total_score
+        board, score = move_lines(self.board, DOWN_LINES)
+        return TwentyFourtyEightBoard(board), score
+
+    def _move_left(self) -> tuple[TwentyFourtyEightBoard, int]:
+        board, score = move_lines(self.board, LEFT_LINES)
+        return TwentyFourtyEightBoard(board), score
+
+    def _move_right(self) -> tuple[TwentyFourtyEightBoard, int]:
+        board, score = move_lines(self.board, RIGHT_LINES)
+        return TwentyFourtyEightBoard(board), score
 
+    # Indexed by _DIRECTION_INDICES.
+    _MOVE_FNS = (_move_up, _move_down, _move_left, _move_right)
+
+    @functools.cached_property
     def _just_values(self) -> list[int]:
         return [cell[0] for row in self.board for cell in row]
 
+    @functools.cached_property
+    def _is_saturated(self) -> bool:
+        return any(value > CELL_MASK for value in self._just_values)
+
     def with_random_tile(self) -> TwentyFourtyEightBoard:
         """Add a random tile to the board."""
-        empty_tiles = [
-            (i, j)
-            for i in range(BOARD_SIZE)
-            for j in range(BOARD_SIZE)
-            if self.board[i][j][0] == 0
-        ]
-        if not empty_tiles:
+        empty_mask = empty_mask_bits(self.values)
+        if not empty_mask:
             return self
-        i, j = random.choice(empty_tiles)
+        for _ in range(random.randrange(empty_mask.bit_count())):
+            empty_mask &= empty_mask - 1
+        cell = ((empty_mask & -empty_mask).bit_length() - 1) // CELL_BITS
         value = 1 if random.random() < 0.9 else 2
 
+        return self.with_specific_tile(*divmod(cell, BOARD_SIZE), value)
+
+    def with_specific_tile(self, i: int, j: int, value: int) -> TwentyFourtyEightBoard:
+        """Add a tile with a given value at a given position to the board."""
         return TwentyFourtyEightBoard(
             insert_value(self.board, i, j, value),
         )
@@ -254,20 +306,14 @@ class State(rx.State):
         return self._board.is_game_over()
 
     @rx.var
-    def board(self) -> list[list[tuple[int, int]]]:
-        """Get the board."""
-        return [list(row) for row in self._board.board]
+    def board_flat(self) -> list[tuple[int, int]]:
+        """Get the cells of the board, row by row."""
+        return [cell for row in self._board.board for cell in row]
 
     @rx.event
     def on_key(self, key):
         """Handle key press."""
-        direction = {
-            "ArrowUp": Direction.UP,
-            "ArrowDown": Direction.DOWN,
-            "ArrowLeft": Direction.LEFT,
-            "ArrowRight": Direction.RIGHT,
-        }[key]
-        new_board, score = self._board.move(direction)
+        new_board, score = self._board.move(_KEY_TO_DIRECTION[key])
         if new_board is not None:
             self._board = new_board.with_random_tile()
             self.score += score
@@ -276,7 +322,14 @@ class State(rx.State):
     async def computer_play(self):
         """Computer play."""
         async with self:
-            self.on_key(self._board.best_move(depth=3, breadth=4)[0].value)
+            board = self._board
+        # Search without holding the state lock, so key presses can interleave.
+        direction, _ = await asyncio.get_running_loop().run_in_executor(
+            None, board.best_move, 3, 4
+        )
+        async with self:
+            if self._board is board:
+                self.on_key(direction.value)
             yield
         # await asyncio.sleep(0.5)
         yield State.computer_play
@@ -319,10 +372,42 @@ def generate_fibonacci(n: int) -> list[int]:
 fibonacci = generate_fibonacci(30)
 fibonacci_var = rx.vars.LiteralArrayVar.create(fibonacci)
 
+# Tile colors indexed by value, values beyond the end of colors get a default.
+tile_styles_var = rx.vars.LiteralArrayVar.create(
+    [
+        {"background_color": background_color, "color": color}
+        for background_color, color in colors
+        + [["#FF1493", "#ffffff"]] * (len(fibonacci) - len(colors))
+    ]
+)
+
 SQUARE_SIZE = "min(100px, 20vw)"
 GAP_SIZE = "min(10px, 2vw)"
 
 
+TILE_STYLE_TEMPLATE = {
+    "width": f"{SQUARE_SIZE}",
+    "height": f"{SQUARE_SIZE}",
+    "border_radius": "5px",
+    "display": "flex",
+    "justify_content": "center",
+    "align_items": "center",
+    "font_size": "min(36px, 6vw)",
+    "color": "black",
+    "position": "absolute",
+}
+
+_LOGO_PATHS = (
+    "M0 11.5999V0.399902H8.96V4.8799H6.72V2.6399H2.24V4.8799H6.72V7.1199H2.24V11.5999H0ZM6.72 11.5999V7.1199H8.96V11.5999H6.72Z",
+    "M11.2 11.5999V0.399902H17.92V2.6399H13.44V4.8799H17.92V7.1199H13.44V9.3599H17.92V11.5999H11.2Z",
+    "M20.16 11.5999V0.399902H26.88V2.6399H22.4V4.8799H26.88V7.1199H22.4V11.5999H20.16Z",
+    "M29.12 11.5999V0.399902H31.36V9.3599H35.84V11.5999H29.12Z",
+    "M38.08 11.5999V0.399902H44.8V2.6399H40.32V4.8799H44.8V7.1199H40.32V9.3599H44.8V11.5999H38.08Z",
+    "M47.04 4.8799V0.399902H49.28V4.8799H47.04ZM53.76 4.8799V0.399902H56V4.8799H53.76ZM49.28 7.1199V4.8799H53.76V7.1199H49.28ZM47.04 11.5999V7.1199H49.28V11.5999H47.04ZM53.76 11.5999V7.1199H56V11.5999H53.76Z",
+)
+_LOGO_PATH_COMPONENTS = tuple(rx.el.svg.path(d=d) for d in _LOGO_PATHS)
+
+
 def svg_logo(color: Union[str, rx.Var[str]] = rx.color_mode_cond("#110F1F", "white")):
     """A Reflex logo SVG.
 
@@ -332,23 +417,8 @@ def svg_logo(color: Union[str, rx.Var[str]] = rx.color_mode_cond("#110F1F", "whi
     Returns:
         The Reflex logo SVG.
     """
-
-    def logo_path(d):
-        return rx.el.svg.path(
-            d=d,
-        )
-
-    paths = [
-        "M0 11.5999V0.399902H8.96V4.8799H6.72V2.6399H2.24V4.8799H6.72V7.1199H2.24V11.5999H0ZM6.72 11.5999V7.1199H8.96V11.5999H6.72Z",
-        "M11.2 11.5999V0.399902H17.92V2.6399H13.44V4.8799H17.92V7.1199H13.44V9.3599H17.92V11.5999H11.2Z",
-        "M20.16 11.5999V0.399902H26.88V2.6399H22.4V4.8799H26.88V7.1199H22.4V11.5999H20.16Z",
-        "M29.12 11.5999V0.399902H31.36V9.3599H35.84V11.5999H29.12Z",
-        "M38.08 11.5999V0.399902H44.8V2.6399H40.32V4.8799H44.8V7.1199H40.32V9.3599H44.8V11.5999H38.08Z",
-        "M47.04 4.8799V0.399902H49.28V4.8799H47.04ZM53.76 4.8799V0.399902H56V4.8799H53.76ZM49.28 7.1199V4.8799H53.76V7.1199H49.28ZM47.04 11.5999V7.1199H49.28V11.5999H47.04ZM53.76 11.5999V7.1199H56V11.5999H53.76Z",
-    ]
-
     return rx.el.svg(
-        *[logo_path(d) for d in paths],
+        *_LOGO_PATH_COMPONENTS,
         width="56",
         height="12",
         viewBox="0 0 56 12",
@@ -360,18 +430,11 @@ def svg_logo(color: Union[str, rx.Var[str]] = rx.color_mode_cond("#110F1F", "whi
 def render_tile(value: int, key: int, i: int, j: int):
     """Render a tile."""
     text = fibonacci_var[value]
+    tile_style = tile_styles_var[value]
 
     style = rx.Style(
         {
-            "width": f"{SQUARE_SIZE}",
-            "height": f"{SQUARE_SIZE}",
-            "border_radius": "5px",
-            "display": "flex",
-            "justify_content": "center",
-            "align_items": "center",
-            "font_size": "min(36px, 6vw)",
-            "color": "black",
-            "position": "absolute",
+            **TILE_STYLE_TEMPLATE,
             "top": f"calc({i} * ({SQUARE_SIZE} + {GAP_SIZE}))",
             "left": f"calc({j} * ({SQUARE_SIZE} + {GAP_SIZE}))",
             "z_index": value,
@@ -417,16 +480,8 @@ def render_tile(value: int, key: int, i: int, j: int):
                 "scale": [1, 1.25, 0],
             },
         ),
-        background_color=rx.match(
-            value,
-            *[(i, color) for i, (color, _) in enumerate(colors)],
-            "#FF1493",
-        ),
-        color=rx.match(
-            value,
-            *[(i, color) for i, (_, color) in enumerate(colors)],
-            "#ffffff",
-        ),
+        background_color=tile_style["background_color"],
+        color=tile_style["color"],
         style=style,
     )
 
@@ -498,8 +553,8 @@ def board():
             rx.foreach(
                 rx.Var.range(BOARD_SIZE**2),
                 lambda x: render_tile(
-                    State.board[x // BOARD_SIZE][x % BOARD_SIZE][0],
-                    State.board[x // BOARD_SIZE][x % BOARD_SIZE][1],
+                    State.board_flat[x][0],
+                    State.board_flat[x][1],
                     x // BOARD_SIZE,
                     x % BOARD_SIZE,
                 ),
@@ -515,6 +570,9 @@ def board():
     )
 
 
+_DIRECTION_KEYS_VAR = LiteralArrayVar.create(list(_KEY_TO_DIRECTION))
+
+
 def index() -> rx.Component:
     """Index page."""
     return rx.fragment(
@@ -547,9 +605,7 @@ def index() -> rx.Component:
         ),
         global_hotkey_watcher(
             on_key_down=lambda key: rx.cond(
-                LiteralArrayVar.create(
-                    ["ArrowUp", "ArrowDown", "ArrowLeft", "ArrowRight"]
-                ).contains(key),
+                _DIRECTION_KEYS_VAR.contains(key),
                 State.on_key(key),
                 rx.noop(),
             )